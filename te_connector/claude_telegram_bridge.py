@@ -6,37 +6,42 @@ Runs on your desktop, polls Telegram for messages, runs Claude, sends responses
 import os
 import sys
 import time
+import json
+import asyncio
+import shutil
+import threading
 import subprocess
-import requests
+import aiohttp
 from datetime import datetime
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from dotenv import dotenv_values
 import signal
-import filelock
+import atexit
 import re
 
 # ============== LOAD CONFIG ==============
-def load_config():
-    """Load configuration from config.env file."""
-    config_path = Path(__file__).parent / "config.env"
-    if config_path.exists():
-        with open(config_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip()
-                    # Remove quotes if present
-                    if (value.startswith('"') and value.endswith('"')) or (value.startswith("'") and value.endswith("'")):
-                        value = value[1:-1]
-                    os.environ.setdefault(key, value)
-
-load_config()
-
-BOT_TOKEN = os.environ.get("TG_BOT_TOKEN", "").strip()
-CHAT_ID = os.environ.get("TG_CHAT_ID", "").strip()
-ALLOWED_USER_ID = os.environ.get("TG_ALLOWED_USER_ID", CHAT_ID).strip()
-REPO_DIR = os.environ.get("REPO_DIR", os.getcwd()).strip()
+# Parse config.env once into a dict instead of hand-rolling the
+# quote-stripping loop and pushing every key into the process env.
+CONFIG = {
+    key: value
+    for key, value in dotenv_values(Path(__file__).parent / "config.env").items()
+    if value is not None
+}
+
+
+def get_config(key, default=""):
+    """Look up a config value; the process environment still wins."""
+    return os.environ.get(key, CONFIG.get(key, default)).strip()
+
+
+BOT_TOKEN = get_config("TG_BOT_TOKEN")
+CHAT_ID = get_config("TG_CHAT_ID")
+ALLOWED_USER_ID = get_config("TG_ALLOWED_USER_ID", CHAT_ID)
+REPO_DIR = get_config("REPO_DIR", os.getcwd())
 
 # Validate required config
 if not BOT_TOKEN or not CHAT_ID:
@@ -49,141 +54,506 @@ CLAUDE_TIMEOUT = 600  # 10 minutes max per request
 # ============================================
 
 
+class TokenBucket:
+    """
+    Client-side rate limiter: stay under Telegram's ~30 msg/s bot cap
+    instead of discovering it through 429 responses.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def consume(self):
+        """Wait until one token is available, then take it."""
+        # Refill-and-take runs without awaits, so the event loop
+        # serializes concurrent consumers for us.
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _smart_split(text, limit=4000):
+    """
+    Yield Telegram-sized chunks, preferring to cut at a blank line, then
+    a newline, then a space instead of mid-word. ``` code fences are kept
+    balanced: a chunk ending inside a fence is closed and the fence is
+    reopened at the start of the next one, so parse_mode rendering
+    survives the split.
+    """
+    pos = 0
+    n = len(text)
+    reopen = False
+
+    while pos < n:
+        prefix = "```\n" if reopen else ""
+        # Reserve room for the reopening prefix and a possible closing fence
+        budget = limit - len(prefix) - 4
+
+        if n - pos <= budget:
+            yield prefix + text[pos:]
+            return
+
+        window = text[pos:pos + budget]
+        cut = window.rfind('\n\n')
+        delim_len = 2
+        if cut <= 0:
+            cut, delim_len = window.rfind('\n'), 1
+        if cut <= 0:
+            cut, delim_len = window.rfind(' '), 1
+        if cut <= 0:
+            cut, delim_len = budget, 0
+
+        chunk = prefix + text[pos:pos + cut]
+        # Swallow only the matched delimiter — anything after it (e.g.
+        # the indentation of the next line) belongs to the next chunk
+        pos += cut + delim_len
+
+        if chunk.count('```') % 2 == 1:
+            yield chunk + "\n```"
+            reopen = True
+        else:
+            yield chunk
+            reopen = False
+
+
 class TelegramBot:
     def __init__(self, token, chat_id):
         self.token = token
         self.chat_id = chat_id
         self.base_url = f"https://api.telegram.org/bot{token}"
 
-    def send_message(self, text, parse_mode=None):
+        # One aiohttp session for everything: keep-alive amortizes the
+        # TLS handshake and the connector caps concurrent connections.
+        self._session = None
+
+        # Multi-chunk messages go out concurrently, throttled below the
+        # 30 msg/s Telegram limit.
+        self._bucket = TokenBucket(rate=25, capacity=30)
+
+    def _ensure_session(self):
+        """Create the shared session lazily, on the running loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=8, enable_cleanup_closed=True),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self._session
+
+    async def send_message(self, text, parse_mode=None):
         """Send a text message, splitting if too long."""
         url = f"{self.base_url}/sendMessage"
-        chunks = [text[i:i+4000] for i in range(0, len(text), 4000)]
 
-        for chunk in chunks:
-            data = {"chat_id": self.chat_id, "text": chunk}
-            if parse_mode:
-                data["parse_mode"] = parse_mode
+        # Chunks must arrive in order, so each POST waits for the
+        # previous one; the token bucket still paces them and other
+        # coroutines keep running in between.
+        for chunk in _smart_split(text):
+            await self._post_chunk(url, chunk, parse_mode)
+
+    MAX_SEND_RETRIES = 3
+
+    async def _post_chunk(self, url, chunk, parse_mode):
+        """
+        POST a single message chunk, rate-limited by the token bucket.
+        Honors Telegram's 429 retry_after and backs off exponentially on
+        5xx, giving up after MAX_SEND_RETRIES attempts.
+        """
+        data = {"chat_id": self.chat_id, "text": chunk}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+
+        for attempt in range(self.MAX_SEND_RETRIES):
             try:
-                response = requests.post(url, json=data, timeout=30)
-                if not response.ok:
-                    print(f"[ERROR] Failed to send message: {response.status_code} {response.text}")
-                else:
-                    print(f"[OK] Message sent ({len(chunk)} chars)")
+                await self._bucket.consume()
+                session = self._ensure_session()
+                async with session.post(url, json=data) as response:
+                    if response.status == 200:
+                        print(f"[OK] Message sent ({len(chunk)} chars)")
+                        return
+
+                    if response.status == 429:
+                        payload = await response.json()
+                        retry_after = float(payload.get("parameters", {}).get("retry_after", 1))
+                        print(f"[WARN] Rate limited (429), retrying in {retry_after}s...")
+                        await asyncio.sleep(retry_after + 0.1)
+                        continue
+
+                    if response.status >= 500:
+                        wait = 0.5 * 2 ** attempt
+                        print(f"[WARN] Telegram {response.status}, retrying in {wait}s...")
+                        await asyncio.sleep(wait)
+                        continue
+
+                    # 4xx other than 429 will not get better on retry
+                    body = await response.text()
+                    print(f"[ERROR] Failed to send message: {response.status} {body}")
+                    return
+
             except Exception as e:
                 print(f"[ERROR] Error sending message: {e}")
+                return
+
+        print(f"[ERROR] Failed to send message after {self.MAX_SEND_RETRIES} attempts")
 
-    def send_file(self, file_path, caption=""):
+    async def send_file(self, file_path, caption=""):
         """Send a file (screenshot, etc.)."""
-        url = f"{self.base_url}/sendDocument"
-        try:
-            with open(file_path, "rb") as f:
-                requests.post(
-                    url,
-                    data={"chat_id": self.chat_id, "caption": caption[:1024]},
-                    files={"document": f},
-                    timeout=60
-                )
-        except Exception as e:
-            print(f"Error sending file: {e}")
+        await self._post_upload("sendDocument", "document", file_path, caption)
 
-    def send_photo(self, file_path, caption=""):
+    async def send_photo(self, file_path, caption=""):
         """Send a photo/screenshot."""
-        url = f"{self.base_url}/sendPhoto"
+        await self._post_upload("sendPhoto", "photo", file_path, caption)
+
+    async def _post_upload(self, method, field, file_path, caption):
+        """Upload a local file as multipart form data."""
+        url = f"{self.base_url}/{method}"
         try:
-            with open(file_path, "rb") as f:
-                requests.post(
-                    url,
-                    data={"chat_id": self.chat_id, "caption": caption[:1024]},
-                    files={"photo": f},
-                    timeout=60
-                )
+            content = await asyncio.to_thread(Path(file_path).read_bytes)
+            form = aiohttp.FormData()
+            form.add_field("chat_id", str(self.chat_id))
+            form.add_field("caption", caption[:1024])
+            form.add_field(field, content, filename=Path(file_path).name)
+
+            await self._bucket.consume()
+            session = self._ensure_session()
+            async with session.post(
+                url, data=form, timeout=aiohttp.ClientTimeout(total=60)
+            ) as response:
+                if response.status != 200:
+                    body = await response.text()
+                    print(f"[ERROR] Failed to send {field}: {response.status} {body}")
         except Exception as e:
-            print(f"Error sending photo: {e}")
+            print(f"Error sending {field}: {e}")
 
-    def get_updates(self, offset=None, timeout=30):
-        """Long-poll for new messages."""
+    async def get_updates(self, offset=None, timeout=25):
+        """
+        Long-poll for new messages without blocking the event loop.
+        Returns the API response dict, or None when the poll failed so
+        the caller can back off instead of re-polling immediately.
+        """
         url = f"{self.base_url}/getUpdates"
-        params = {"timeout": timeout}
+        params = {
+            "timeout": timeout,
+            # Ask for full batches and only the update type we handle;
+            # channel posts, edits etc. would just be parsed and dropped.
+            "limit": 100,
+            "allowed_updates": json.dumps(["message"]),
+        }
         if offset:
             params["offset"] = offset
         try:
-            response = requests.get(url, params=params, timeout=timeout + 10)
-            data = response.json()
+            session = self._ensure_session()
+            async with session.get(
+                url, params=params, timeout=aiohttp.ClientTimeout(total=timeout + 5)
+            ) as response:
+                data = await response.json()
             if not data.get("ok"):
                 error_msg = data.get("description", "Unknown error")
                 print(f"[ERROR] Telegram API Error: {error_msg}")
-                return {"result": []}
+                return None
             return data
         except Exception as e:
             print(f"[ERROR] Error getting updates: {e}")
-            return {"result": []}
+            return None
+
+    async def close(self):
+        """Close the shared session."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+class ClaudeProcessPool:
+    """
+    Bounded LRU pool of warm Claude CLI processes.
+
+    Each process is started once in stream-json mode and kept alive, so
+    CLAUDE.md / plugin / MCP loading happens once per session instead of
+    on every message. Prompts go in as JSON lines on stdin and responses
+    come back as JSON events on stdout.
+    """
+
+    # Streamed flush window: kept below _smart_split's effective budget
+    # (limit minus fence headroom) so one flush maps to exactly one POST
+    STREAM_FLUSH_CHARS = 3900
+
+    def __init__(self, repo_dir, max_processes=4):
+        self.repo_dir = repo_dir
+        self.max_processes = max_processes
+        self.processes = OrderedDict()  # session_key -> subprocess.Popen, LRU order
+        self.in_flight = set()  # session_keys currently mid-turn, never evicted
+
+    async def _spawn(self):
+        """Start one persistent claude process in stream-json mode."""
+        print("[ClaudePool] Spawning warm claude process...")
+        return await asyncio.create_subprocess_exec(
+            "claude",
+            "--dangerously-skip-permissions",
+            "-p",
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose",
+            cwd=self.repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    async def acquire(self, session_key):
+        """Get a live process for this session, respawning dead ones."""
+        proc = self.processes.get(session_key)
+        if proc is not None and proc.returncode is None:
+            self.processes.move_to_end(session_key)
+            return proc
+
+        if proc is not None:
+            print(f"[ClaudePool] Process for {session_key} died (rc={proc.returncode}), respawning")
+            self.processes.pop(session_key, None)
+
+        proc = await self._spawn()
+        self.processes[session_key] = proc
+
+        # Evict least-recently-used *idle* sessions beyond the bound;
+        # a process that is mid-turn must never be killed under its
+        # caller, so when every other session is busy we temporarily run
+        # over the bound instead.
+        if len(self.processes) > self.max_processes:
+            for old_key in list(self.processes):
+                if len(self.processes) <= self.max_processes:
+                    break
+                if old_key == session_key or old_key in self.in_flight:
+                    continue
+                # _terminate awaits, so a concurrent acquire may already
+                # have evicted a key from our snapshot in the meantime
+                old_proc = self.processes.pop(old_key, None)
+                if old_proc is None:
+                    continue
+                print(f"[ClaudePool] Evicting LRU session {old_key}")
+                await self._terminate(old_proc)
+
+        return proc
+
+    async def discard(self, session_key):
+        """Drop (and kill) the process for a session, e.g. after a timeout."""
+        proc = self.processes.pop(session_key, None)
+        if proc is not None:
+            await self._terminate(proc)
+
+    async def request(self, prompt, session_key, timeout=CLAUDE_TIMEOUT, on_output=None):
+        """
+        Send one prompt to the session's warm process and collect the
+        response. Reads stream-json events until the terminal 'result'
+        event for this turn arrives; the whole turn shares one deadline.
+
+        When on_output (an async callable) is given, assistant text is
+        streamed out in STREAM_FLUSH_CHARS windows — or sooner after 2s
+        of idle — instead of being held until the turn finishes.
+        Returns (final_text, streamed_any); final_text is empty when the
+        whole response already went through on_output.
+        """
+        proc = await self.acquire(session_key)
+        deadline = time.monotonic() + timeout
+
+        # Mark the session busy so LRU eviction leaves it alone mid-turn
+        self.in_flight.add(session_key)
+        try:
+            return await self._converse(proc, prompt, session_key, deadline, timeout, on_output)
+        finally:
+            self.in_flight.discard(session_key)
+
+    async def _converse(self, proc, prompt, session_key, deadline, timeout, on_output):
+        """One write/read exchange with a pooled process (see request)."""
+        message = {
+            "type": "user",
+            "message": {"role": "user", "content": [{"type": "text", "text": prompt}]},
+        }
+        proc.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+        await proc.stdin.drain()
+
+        buffer = ""
+        streamed_any = False
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await self.discard(session_key)
+                raise TimeoutError(f"Claude turn exceeded {timeout}s")
+
+            # With pending streamable text, wake up after 2s of silence
+            # to flush it rather than sitting on it until the deadline.
+            idle_read = on_output is not None and bool(buffer)
+            try:
+                line = await asyncio.wait_for(
+                    proc.stdout.readline(),
+                    timeout=min(remaining, 2.0) if idle_read else remaining,
+                )
+            except asyncio.TimeoutError:
+                if idle_read and remaining > 2.0:
+                    await on_output(buffer)
+                    buffer = ""
+                    streamed_any = True
+                    continue
+                await self.discard(session_key)
+                raise TimeoutError(f"Claude turn exceeded {timeout}s")
+
+            if not line:
+                # stdout closed without a result event: died mid-turn
+                await self.discard(session_key)
+                raise RuntimeError(f"Claude process exited mid-turn (rc={proc.returncode})")
+
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            if event.get("type") == "assistant" and on_output is not None:
+                for block in event.get("message", {}).get("content", []):
+                    if block.get("type") == "text" and block.get("text"):
+                        buffer += block["text"]
+                while len(buffer) >= self.STREAM_FLUSH_CHARS:
+                    await on_output(buffer[:self.STREAM_FLUSH_CHARS])
+                    buffer = buffer[self.STREAM_FLUSH_CHARS:]
+                    streamed_any = True
+
+            elif event.get("type") == "result":
+                if event.get("is_error"):
+                    raise RuntimeError(event.get("result") or "Claude returned an error")
+                if on_output is not None and (streamed_any or buffer):
+                    if buffer:
+                        await on_output(buffer)
+                    return "", True
+                return event.get("result") or "", False
+
+    async def _terminate(self, proc):
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except Exception:
+            try:
+                proc.kill()
+            except Exception:
+                pass
+
+    async def close_all(self):
+        """Kill every pooled process (shutdown path)."""
+        while self.processes:
+            _, proc = self.processes.popitem()
+            await self._terminate(proc)
 
 
 class ClaudeRunner:
+    MAX_PARALLEL_TURNS = 4
+
     def __init__(self, repo_dir):
         self.repo_dir = repo_dir
         self.is_running = False
+        self.pool = ClaudeProcessPool(repo_dir)
+        # Bound concurrent turns; callers send their placeholder before
+        # awaiting run() so queued chats are not silently starved.
+        self.turn_semaphore = asyncio.Semaphore(self.MAX_PARALLEL_TURNS)
 
-    def run(self, prompt, timeout=CLAUDE_TIMEOUT):
-        """Run Claude Code CLI with the given prompt."""
-        self.is_running = True
+    async def run(self, prompt, timeout=CLAUDE_TIMEOUT, session_key="default", on_output=None):
+        """
+        Run a prompt through a warm pooled Claude process. With
+        on_output, partial text is streamed through the callback and the
+        return value is empty once everything has been delivered.
+        """
+        async with self.turn_semaphore:
+            self.is_running = True
+            try:
+                output, streamed = await self.pool.request(
+                    prompt, session_key, timeout=timeout, on_output=on_output
+                )
+                output = output.strip()
+                if output:
+                    return output
+                return "" if streamed else "Claude completed (no output)"
+
+            except TimeoutError:
+                return "[TIMEOUT] Claude timed out after 10 minutes. The task might be too complex."
+            except FileNotFoundError:
+                return "[ERROR] Claude CLI not found. Make sure 'claude' is in your PATH."
+            except Exception as e:
+                return f"[ERROR] Error running Claude: {str(e)}"
+            finally:
+                self.is_running = False
 
-        cmd = [
-            "claude",
-            "--dangerously-skip-permissions",
-            "-p", prompt
-        ]
+    def _commit_with_pygit2(self, branch_name, message):
+        """
+        Branch, stage and commit in-process via libgit2 — no process
+        spawns, and the commit message needs no shell quoting.
+        """
+        import pygit2
 
-        try:
-            result = subprocess.run(
-                cmd,
-                cwd=self.repo_dir,
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-                shell=True
-            )
+        repo = pygit2.Repository(str(self.repo_dir))
+        head_commit = repo[repo.head.target]
 
-            output = result.stdout or ""
-            if result.stderr:
-                output += f"\n\n[stderr]: {result.stderr}"
+        # Equivalent of `git checkout -b`: point HEAD at the new branch
+        # without touching the (dirty) worktree
+        repo.branches.local.create(branch_name, head_commit)
+        repo.set_head(f"refs/heads/{branch_name}")
 
-            return output.strip() if output.strip() else "Claude completed (no output)"
+        index = repo.index
+        index.add_all()
+        # add_all only stages files that still exist; to match the
+        # `git add -A` it replaces, stage worktree deletions explicitly
+        for path, flags in repo.status().items():
+            if flags & pygit2.GIT_STATUS_WT_DELETED:
+                index.remove(path)
+        index.write()
+        tree = index.write_tree()
 
-        except subprocess.TimeoutExpired:
-            return "[TIMEOUT] Claude timed out after 10 minutes. The task might be too complex."
-        except FileNotFoundError:
-            return "[ERROR] Claude CLI not found. Make sure 'claude' is in your PATH."
-        except Exception as e:
-            return f"[ERROR] Error running Claude: {str(e)}"
-        finally:
-            self.is_running = False
+        signature = repo.default_signature
+        repo.create_commit("HEAD", signature, signature, message, tree, [head_commit.id])
 
     def create_pr(self, description):
         """Create a PR using GitHub CLI."""
         try:
+            # CPython only takes the posix_spawn/vfork fast path when the
+            # executable is an absolute path and no cwd= or close_fds is
+            # requested, so resolve git once, address the repo with -C,
+            # and leave our fds inheritable — the children are short-lived
+            # git calls, so leaking the lock fd / sockets to them is fine.
+            git = [shutil.which("git") or "git", "-C", str(self.repo_dir)]
+
             status = subprocess.run(
-                ["git", "status", "--porcelain"],
-                cwd=self.repo_dir,
+                git + ["status", "--porcelain"],
                 capture_output=True,
-                text=True
+                text=True,
+                close_fds=False
             )
 
             if not status.stdout.strip():
                 return "No changes to commit. Make some changes first!"
 
             branch_name = f"claude/{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            commit_msg = f"Claude: {description[:50]}"
 
-            commands = [
-                ["git", "checkout", "-b", branch_name],
-                ["git", "add", "-A"],
-                ["git", "commit", "-m", f"Claude: {description[:50]}"],
-                ["git", "push", "-u", "origin", branch_name],
-            ]
+            try:
+                # checkout/add/commit all in-process
+                self._commit_with_pygit2(branch_name, commit_msg)
+                commands = []
+            except ImportError:
+                # pygit2 not installed: fall back to one git call per step
+                commands = [
+                    git + ["checkout", "-b", branch_name],
+                    git + ["add", "-A"],
+                    git + ["commit", "-m", commit_msg],
+                ]
+
+            # push always shells out — it needs the SSH agent / credentials
+            commands.append(git + ["push", "-u", "origin", branch_name])
 
             for cmd in commands:
-                result = subprocess.run(cmd, cwd=self.repo_dir, capture_output=True, text=True)
+                result = subprocess.run(cmd, capture_output=True, text=True, close_fds=False)
                 if result.returncode != 0:
                     return f"[ERROR] Failed at: {' '.join(cmd)}\n{result.stderr}"
 
@@ -204,141 +574,206 @@ class ClaudeRunner:
             return f"[ERROR] Error creating PR: {str(e)}"
 
 
+class _QuietHTTPHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler without per-request stderr logging."""
+
+    def log_message(self, format, *args):
+        pass
+
+
 class ScreenshotTaker:
+    # Directories never worth descending into while looking for HTML
+    EXCLUDE_DIRS = {'.git', 'node_modules', 'venv', '__pycache__', '.venv'}
+    # Preferred names for the 'default' page, best first
+    PRIORITY_NAMES = ('index.html', 'main.html', 'gold_webpage.html')
+    # Evict oldest screenshots once the directory grows past this
+    MAX_SCREENSHOT_BYTES = 100 * 1024 * 1024
+
     def __init__(self, repo_dir):
         # Use absolute path based on script location
         self.screenshot_dir = Path(__file__).parent / "screenshots"
         self.screenshot_dir.mkdir(exist_ok=True)
         self.repo_dir = Path(repo_dir)
         self.html_files_cache = None
+        self.html_cache_path = self.screenshot_dir / ".html_cache.json"
+        # Warm resources, started on first use and reused for the whole
+        # process lifetime (server thread + Playwright browser).
+        self._http_server = None
+        self._http_server_lock = threading.Lock()
+        self._playwright = None
+        self._browser = None
+        # Recent renders keyed by (html path, mtime); a repeat shot of an
+        # unchanged file re-sends the PNG instead of re-rendering.
+        self._shot_cache = OrderedDict()
+        self._shot_cache_max = 16
+        # The Playwright sync API is bound to the thread that created it,
+        # so all rendering runs on this single dedicated worker.
+        self._render_executor = ThreadPoolExecutor(max_workers=1)
+        # Directory pruning happens off the hot path on its own thread
+        self._cleanup_executor = ThreadPoolExecutor(max_workers=1)
         print(f"[ScreenshotTaker] Using directory: {self.screenshot_dir}")
 
     def find_html_files(self):
         """
         Find all HTML files in the project directory.
         Returns dict mapping keywords to file paths.
+
+        Results are cached in memory and persisted to a JSON cache that
+        is invalidated when any known HTML file's mtime changes, so the
+        directory walk runs only when the tree actually changed.
         """
         if self.html_files_cache:
             return self.html_files_cache
 
+        mapping = self._load_cached_mapping()
+        if mapping is None:
+            mapping = self._scan_and_map()
+
+        self.html_files_cache = mapping
+        return mapping
+
+    def _load_cached_mapping(self):
+        """Return the persisted mapping if it is still fresh, else None."""
+        try:
+            with open(self.html_cache_path, 'r') as f:
+                cached = json.load(f)
+            files = cached['files']  # path -> recorded mtime
+            if not files:
+                return None
+            # Fresh as long as every known file still exists with its
+            # recorded mtime: one stat per file instead of a re-walk.
+            for path, mtime in files.items():
+                if os.stat(path).st_mtime != mtime:
+                    return None
+            mapping = {k: Path(v) for k, v in cached['mapping'].items()}
+            print(f"[HTMLDiscovery] Using cached index ({len(files)} HTML files)")
+            return mapping
+        except (OSError, KeyError, ValueError, AttributeError):
+            return None
+
+    def _scan_and_map(self):
+        """Walk the repo once with os.scandir and build the keyword mapping."""
         print(f"[HTMLDiscovery] Scanning {self.repo_dir} for HTML files...")
 
-        html_files = []
-        exclude_patterns = {'.git', 'node_modules', 'venv', '__pycache__', '.venv'}
+        html_files = {}  # path -> mtime
+        seen_inodes = set()
+        best_priority = len(self.PRIORITY_NAMES)  # index into PRIORITY_NAMES
+        best_file = None
+        first_file = None
 
         try:
-            for html_file in self.repo_dir.rglob('*.html'):
-                # Check if path contains excluded directories
-                if any(excluded in html_file.parts for excluded in exclude_patterns):
+            # Iterative DFS that prunes excluded directories before
+            # descending, so .git/node_modules are never walked at all.
+            stack = [str(self.repo_dir)]
+            while stack:
+                current = stack.pop()
+                try:
+                    with os.scandir(current) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in self.EXCLUDE_DIRS:
+                                    stack.append(entry.path)
+                            elif entry.name.endswith('.html'):
+                                st = entry.stat()
+                                # Skip hard links / symlinks to a file we
+                                # already indexed under another path
+                                inode = (st.st_dev, st.st_ino)
+                                if inode in seen_inodes:
+                                    continue
+                                seen_inodes.add(inode)
+                                html_files[entry.path] = st.st_mtime
+                                if first_file is None:
+                                    first_file = entry.path
+                                # Track the best 'default' candidate during
+                                # the walk instead of sorting afterwards
+                                if entry.name in self.PRIORITY_NAMES:
+                                    priority = self.PRIORITY_NAMES.index(entry.name)
+                                    if priority < best_priority:
+                                        best_priority = priority
+                                        best_file = entry.path
+                except OSError:
                     continue
-                html_files.append(html_file)
 
             if not html_files:
                 print(f"[HTMLDiscovery] No HTML files found in {self.repo_dir}")
                 return None
 
-            # Sort for consistent ordering
-            html_files.sort()
             print(f"[HTMLDiscovery] Found {len(html_files)} HTML files")
 
-            # Create mapping with priority
-            mapping = {}
-
-            # Determine default - prioritize index.html, then main.html, then gold_webpage.html
-            for priority_name in ['index.html', 'main.html', 'gold_webpage.html']:
-                for html_file in html_files:
-                    if html_file.name == priority_name:
-                        mapping['default'] = html_file
-                        break
-                if 'default' in mapping:
-                    break
-
-            # Fallback to first found
-            if 'default' not in mapping:
-                mapping['default'] = html_files[0]
-
-            # Set project/build/app mappings
-            mapping['project'] = mapping['default']
-            mapping['build'] = mapping['default']
-            mapping['app'] = mapping['default']
+            default = Path(best_file if best_file else first_file)
+            mapping = {
+                'default': default,
+                'project': default,
+                'build': default,
+                'app': default,
+            }
 
             print(f"[HTMLDiscovery] Mapping: {[(k, v.name) for k, v in mapping.items()]}")
 
-            self.html_files_cache = mapping
+            self._save_cached_mapping(html_files, mapping)
             return mapping
 
         except Exception as e:
             print(f"[HTMLDiscovery] ERROR: {e}")
             return None
 
-    def start_http_server(self, directory, port=8000, max_retries=5):
+    def _save_cached_mapping(self, html_files, mapping):
+        """Persist the discovery results next to the screenshots."""
+        try:
+            with open(self.html_cache_path, 'w') as f:
+                json.dump({
+                    'files': html_files,
+                    'mapping': {k: str(v) for k, v in mapping.items()},
+                }, f)
+        except OSError as e:
+            print(f"[HTMLDiscovery] Could not write cache: {e}")
+
+    def _ensure_http_server(self):
         """
-        Start a temporary HTTP server in the given directory.
-        Returns: (subprocess.Popen, actual_port, base_url) or (None, None, None) on failure
+        Start the repo-rooted HTTP server once and keep it for the
+        process lifetime. Returns the base URL, or None on failure.
+        Called from to_thread workers, so the init is lock-guarded to
+        keep two concurrent shots from each starting a server.
         """
-        directory = Path(directory)
+        with self._http_server_lock:
+            if self._http_server is not None:
+                return f"http://127.0.0.1:{self._http_server.server_address[1]}"
 
-        if not directory.exists():
-            print(f"[HTTPServer] Directory does not exist: {directory}")
-            return None, None, None
+            if not self.repo_dir.exists():
+                print(f"[HTTPServer] Directory does not exist: {self.repo_dir}")
+                return None
 
-        for attempt in range(max_retries):
-            current_port = port + attempt
             try:
-                print(f"[HTTPServer] Attempting to start server on port {current_port}...")
-
-                server_process = subprocess.Popen(
-                    ["python", "-m", "http.server", str(current_port), "--directory", str(directory)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-
-                # Wait for server to start
-                time.sleep(2)
-
-                # Verify server is running by making a request
-                try:
-                    response = requests.get(f"http://localhost:{current_port}", timeout=3)
-                    print(f"[HTTPServer] Server started successfully on port {current_port}")
-                    return server_process, current_port, f"http://localhost:{current_port}"
-                except requests.ConnectionError:
-                    server_process.terminate()
-                    continue
-
+                handler = partial(_QuietHTTPHandler, directory=str(self.repo_dir))
+                # Port 0 lets the kernel pick a free port; the socket is
+                # bound before serve_forever starts, so no startup sleep.
+                server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                thread.start()
+                self._http_server = server
+                port = server.server_address[1]
+                print(f"[HTTPServer] Serving {self.repo_dir} on port {port}")
+                return f"http://127.0.0.1:{port}"
             except Exception as e:
-                print(f"[HTTPServer] Port {current_port} failed: {e}")
-                continue
-
-        print(f"[HTTPServer] Failed to start server on ports {port}-{port+max_retries-1}")
-        return None, None, None
+                print(f"[HTTPServer] Failed to start server: {e}")
+                return None
 
-    def stop_http_server(self, server_process):
-        """
-        Stop the HTTP server process gracefully.
-        """
-        if not server_process:
-            return
+    def _ensure_browser(self):
+        """Launch the Playwright browser once and reuse it."""
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
 
-        try:
-            print(f"[HTTPServer] Stopping server (PID: {server_process.pid})...")
-            server_process.terminate()
+        from playwright.sync_api import sync_playwright
 
-            try:
-                server_process.wait(timeout=5)
-                print("[HTTPServer] Server stopped gracefully")
-            except subprocess.TimeoutExpired:
-                print("[HTTPServer] Server did not stop, forcing kill...")
-                server_process.kill()
-                server_process.wait()
-                print("[HTTPServer] Server force killed")
-
-        except Exception as e:
-            print(f"[HTTPServer] Error stopping server: {e}")
+        if self._playwright is None:
+            self._playwright = sync_playwright().start()
+        print("[Screenshot] Launching chromium...")
+        self._browser = self._playwright.chromium.launch()
+        return self._browser
 
     def take_project_screenshot(self, html_keyword='default'):
         """
-        Take screenshot of a local HTML file.
-        Starts HTTP server, takes screenshot, stops server.
+        Take screenshot of a local HTML file via the warm HTTP server.
         """
         try:
             # Find HTML files
@@ -355,26 +790,31 @@ class ScreenshotTaker:
 
             print(f"[ProjectShot] Target: {html_keyword} -> {html_file.name}")
 
-            # Start HTTP server at project root
-            server_process, port, base_url = self.start_http_server(self.repo_dir)
-            if not server_process:
+            # Serve from the render cache when the file is unchanged
+            cache_key = (str(html_file), os.stat(html_file).st_mtime)
+            cached = self._shot_cache.get(cache_key)
+            if cached and Path(cached).exists():
+                self._shot_cache.move_to_end(cache_key)
+                print(f"[ProjectShot] Cache hit: {cached}")
+                return cached
+
+            base_url = self._ensure_http_server()
+            if not base_url:
                 print("[ProjectShot] Failed to start HTTP server")
                 return None
 
-            try:
-                # Build URL - get relative path from repo root
-                relative_path = html_file.relative_to(self.repo_dir)
-                url = f"{base_url}/{relative_path}".replace("\\", "/")
-
-                print(f"[ProjectShot] Screenshot URL: {url}")
+            # Build URL - get relative path from repo root
+            relative_path = html_file.relative_to(self.repo_dir)
+            url = f"{base_url}/{relative_path}".replace("\\", "/")
 
-                # Take screenshot
-                screenshot_path = self.take_browser_screenshot(url)
-                return screenshot_path
+            print(f"[ProjectShot] Screenshot URL: {url}")
 
-            finally:
-                # Always stop server
-                self.stop_http_server(server_process)
+            screenshot_path = self.take_browser_screenshot(url)
+            if screenshot_path:
+                self._shot_cache[cache_key] = screenshot_path
+                while len(self._shot_cache) > self._shot_cache_max:
+                    self._shot_cache.popitem(last=False)
+            return screenshot_path
 
         except Exception as e:
             print(f"[ProjectShot] ERROR: {e}")
@@ -383,28 +823,29 @@ class ScreenshotTaker:
             return None
 
     def take_browser_screenshot(self, url):
-        """Take a screenshot of a URL using Playwright."""
-        try:
-            from playwright.sync_api import sync_playwright
+        """Take a screenshot of a URL using the warm Playwright browser."""
+        return self._render_executor.submit(self._render, url).result()
 
+    def _render(self, url):
+        """Render one page to PNG. Runs on the dedicated render thread."""
+        try:
             screenshot_path = self.screenshot_dir / f"shot_{int(time.time())}.png"
 
             print(f"[Screenshot] Starting for URL: {url}")
             print(f"[Screenshot] Will save to: {screenshot_path}")
 
-            with sync_playwright() as p:
-                print("[Screenshot] Launching chromium...")
-                browser = p.chromium.launch()
-                print("[Screenshot] Creating page...")
-                page = browser.new_page()
+            browser = self._ensure_browser()
+            page = browser.new_page()
+            try:
                 print(f"[Screenshot] Navigating to {url}...")
                 page.goto(url, timeout=30000)
                 print("[Screenshot] Taking screenshot...")
                 page.screenshot(path=str(screenshot_path), full_page=True)
-                print("[Screenshot] Closing browser...")
-                browser.close()
+            finally:
+                page.close()
 
             print(f"[Screenshot] SUCCESS! Saved to: {screenshot_path}")
+            self._cleanup_executor.submit(self._prune_screenshots)
             return str(screenshot_path)
         except ImportError as e:
             print(f"[Screenshot] ImportError: Playwright not installed - {e}")
@@ -415,6 +856,84 @@ class ScreenshotTaker:
             traceback.print_exc()
             return None
 
+    def _prune_screenshots(self):
+        """
+        Evict the oldest screenshots (by mtime) until the directory is
+        back under MAX_SCREENSHOT_BYTES. Runs on the cleanup thread.
+        """
+        try:
+            shots = [p for p in self.screenshot_dir.iterdir() if p.suffix == '.png']
+            shots.sort(key=lambda p: p.stat().st_mtime)
+            total = sum(p.stat().st_size for p in shots)
+
+            while shots and total > self.MAX_SCREENSHOT_BYTES:
+                oldest = shots.pop(0)
+                try:
+                    size = oldest.stat().st_size
+                    oldest.unlink()
+                    total -= size
+                    print(f"[Screenshot] Pruned {oldest.name} ({size} bytes)")
+                except OSError:
+                    continue  # already gone or busy; skip it
+        except Exception as e:
+            print(f"[Screenshot] Cleanup error: {e}")
+
+    def close(self):
+        """Shut down the warm server and browser (shutdown path)."""
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server = None
+        try:
+            if self._browser is not None:
+                self._render_executor.submit(self._browser.close).result(timeout=10)
+            if self._playwright is not None:
+                self._render_executor.submit(self._playwright.stop).result(timeout=10)
+        except Exception as e:
+            print(f"[Screenshot] Error closing browser: {e}")
+        self._render_executor.shutdown(wait=False)
+        self._cleanup_executor.shutdown(wait=False)
+
+
+# Precompiled patterns for parse_screenshot_intent. Compiling once at
+# import keeps the per-message cost to a single C-level scan per group
+# instead of N pattern lookups on every incoming text.
+
+# Trigger words for screenshot commands
+_TRIGGER_RE = re.compile(
+    r'\bscreenshot\b'
+    r'|\bshot\b'
+    r'|\btake\s+a\s+screenshot\b'
+    r'|\bcapture\b'
+    r'|\bsnap\b'
+)
+
+# Action verbs (to avoid false positives like "about screenshots")
+_ACTION_RE = re.compile(
+    r'(?:take|make|capture|create|shoot|snap)'
+    r'|^screenshot\b'
+    r'|^shot\b'
+)
+
+# Target keywords, checked in priority order
+_KEYWORD_RES = [
+    ('page', re.compile(r'\b(?:the\s+)?page\b')),
+    ('project', re.compile(r'\b(?:the\s+)?project\b')),
+    ('build', re.compile(r'\b(?:the\s+)?build\b')),
+    ('app', re.compile(r'\b(?:the\s+)?app(?:lication)?\b')),
+    ('default', re.compile(r'\b(?:the\s+)?(?:webpage|website|site)\b')),
+]
+
+_URL_RE = re.compile(
+    r'(?:https?://[^\s]+)'
+    r'|(?:www\.[^\s]+)'
+    r'|(?:[a-z0-9-]+\.(?:com|org|net|io|co|dev|app|site|web))'
+)
+
+# Words that mark a message as *talking about* screenshots rather than
+# requesting one, matched on whole-word boundaries
+_WORD_RE = re.compile(r'[a-z]+')
+_DISQUALIFIERS = frozenset({'about', 'feature', 'tool', 'tutorial'})
+
 
 def parse_screenshot_intent(text):
     """
@@ -423,68 +942,169 @@ def parse_screenshot_intent(text):
     """
     text_lower = text.lower()
 
-    # Trigger words for screenshot commands
-    trigger_patterns = [
-        r'\bscreenshot\b',
-        r'\bshot\b',
-        r'\btake\s+a\s+screenshot\b',
-        r'\bcapture\b',
-        r'\bsnap\b'
-    ]
-
     # Check if any trigger pattern matches
-    has_trigger = any(re.search(pattern, text_lower) for pattern in trigger_patterns)
-
-    if not has_trigger:
+    if not _TRIGGER_RE.search(text_lower):
         return False, None, None
 
-    # Look for action verbs (to avoid false positives like "about screenshots")
-    action_patterns = [
-        r'(?:take|make|capture|create|shoot|snap)',
-        r'^screenshot\b',
-        r'^shot\b'
-    ]
-
-    has_action = any(re.search(action, text_lower) for action in action_patterns)
-
-    if not has_action:
-        # Avoid false positives like "tell me about screenshots"
-        if any(word in text_lower for word in ['about', 'feature', 'tool', 'tutorial']):
+    if not _ACTION_RE.search(text_lower):
+        # Avoid false positives like "tell me about screenshots".
+        # Tokenizing into a set keeps the check O(1) per word and stops
+        # 'tool' from matching inside e.g. 'toolbar'.
+        words = frozenset(_WORD_RE.findall(text_lower))
+        if words & _DISQUALIFIERS:
             return False, None, None
 
     # Extract target keyword
-    keyword_patterns = {
-        'page': r'\b(?:the\s+)?page\b',
-        'project': r'\b(?:the\s+)?project\b',
-        'build': r'\b(?:the\s+)?build\b',
-        'app': r'\b(?:the\s+)?app(?:lication)?\b',
-        'default': r'\b(?:the\s+)?(?:webpage|website|site)\b'
-    }
-
     target_keyword = None
-    for keyword, pattern in keyword_patterns.items():
-        if re.search(pattern, text_lower):
-            target_keyword = keyword if keyword != 'default' else 'default'
+    for keyword, pattern in _KEYWORD_RES:
+        if pattern.search(text_lower):
+            target_keyword = keyword
             break
 
     # Look for URL in text
     url_match = None
-    url_patterns = [
-        r'(?:https?://[^\s]+)',
-        r'(?:www\.[^\s]+)',
-        r'(?:[a-z0-9-]+\.(?:com|org|net|io|co|dev|app|site|web))'
-    ]
-
-    for pattern in url_patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            url_match = match.group(0)
-            break
+    match = _URL_RE.search(text_lower)
+    if match:
+        url_match = match.group(0)
 
     return True, target_keyword, url_match
 
 
-def main():
+def acquire_instance_lock(lock_path):
+    """
+    Take an exclusive non-blocking lock on lock_path via the kernel
+    (fcntl on POSIX, msvcrt on Windows) — one syscall, no poll loop.
+    Returns the open fd to hold for the process lifetime, or None if
+    another instance already owns the lock.
+    """
+    fd = os.open(str(lock_path), os.O_CREAT | os.O_RDWR)
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def release_instance_lock(fd):
+    """Release and close the instance lock fd."""
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    except OSError:
+        pass
+
+
+async def handle_screenshot(bot, screenshotter, target=None, url=None):
+    """
+    Shared screenshot dispatch for /shot and natural-language requests:
+    send the placeholder, render (or hit the cache), send photo or error.
+    """
+    if url:
+        url = url if url.startswith("http") else "https://" + url
+        await bot.send_message(f"[WAIT] Taking screenshot of {url}...")
+        screenshot_path = await asyncio.to_thread(screenshotter.take_browser_screenshot, url)
+        caption = f"Screenshot: {url}"
+    else:
+        target = target or 'default'
+        await bot.send_message(f"[WAIT] Taking screenshot of {target} page...")
+        screenshot_path = await asyncio.to_thread(screenshotter.take_project_screenshot, target)
+        caption = f"Screenshot: {target.capitalize()} page"
+
+    if screenshot_path:
+        await bot.send_photo(screenshot_path, caption=caption)
+    else:
+        await bot.send_message("[ERROR] Screenshot failed. Check logs.")
+
+
+async def handle_update(update, bot, claude, screenshotter, chat_locks):
+    """
+    Process a single Telegram update.
+    Runs as its own task so polling keeps going while Claude works;
+    a per-chat lock keeps messages from the same chat in order.
+    """
+    message = update.get("message", {})
+    text = message.get("text", "").strip()
+    user_id = str(message.get("from", {}).get("id", ""))
+    chat_id = str(message.get("chat", {}).get("id", ""))
+
+    if not text:
+        return
+
+    # Check authorization
+    if str(user_id) != str(ALLOWED_USER_ID):
+        await bot.send_message("⛔ Unauthorized user")
+        return
+
+    print(f"[{datetime.now()}] Received: {text[:50]}...")
+
+    lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        # Handle commands
+        if text.startswith("/status"):
+            status = "[ONLINE]" if not claude.is_running else "[PROCESSING]"
+            await bot.send_message(f"Status: {status}\nRepo: {REPO_DIR}")
+
+        elif text.startswith("/pr "):
+            description = text[4:].strip()
+            if not description:
+                await bot.send_message("Usage: /pr <description of changes>")
+            else:
+                await bot.send_message("[WAIT] Creating PR...")
+                result = await asyncio.to_thread(claude.create_pr, description)
+                await bot.send_message(result)
+
+        elif text.startswith("/shot"):
+            args = text[5:].strip()  # Get everything after "/shot"
+
+            if not args:
+                # /shot → screenshot default page
+                await handle_screenshot(bot, screenshotter, target='default')
+            elif args.lower() in ['project', 'build', 'app', 'page']:
+                # /shot project|build|app|page
+                await handle_screenshot(bot, screenshotter, target=args.lower())
+            else:
+                # /shot <url> (existing behavior)
+                await handle_screenshot(bot, screenshotter, url=args)
+
+        elif text.startswith("/"):
+            await bot.send_message(
+                "Unknown command. Available:\n/status\n/pr <description>\n/shot <url>"
+            )
+
+        else:
+            # Check for natural language screenshot commands
+            is_screenshot, keyword, url = parse_screenshot_intent(text)
+
+            if is_screenshot:
+                await handle_screenshot(bot, screenshotter, target=keyword, url=url)
+                return  # Skip Claude processing
+
+            # If not a screenshot command, run Claude in a worker thread so
+            # the event loop (polling, other chats) keeps moving.
+            await bot.send_message("[WAIT] Claude is thinking...")
+            # Partial output streams straight to the chat as it arrives;
+            # anything left over (or a non-streamed reply) is sent after.
+            response = await claude.run(text, session_key=chat_id, on_output=bot.send_message)
+            if response:
+                await bot.send_message(response)
+                print(f"[{datetime.now()}] Responded ({len(response)} chars)")
+            else:
+                print(f"[{datetime.now()}] Responded (streamed)")
+
+
+async def async_main():
     print("=" * 50)
     print("Claude Telegram Bridge Starting...")
     print(f"Repo: {REPO_DIR}")
@@ -492,21 +1112,15 @@ def main():
 
     # Acquire lock to prevent multiple instances
     lock_file = Path(__file__).parent / ".bot.lock"
-    lock = filelock.FileLock(str(lock_file), timeout=1)
-
-    try:
-        lock.acquire(timeout=0)
-    except filelock.Timeout:
+    lock_fd = acquire_instance_lock(lock_file)
+    if lock_fd is None:
         print("[ERROR] Another bot instance is already running!")
         print("[ERROR] Kill it first with: taskkill /F /IM python.exe")
         sys.exit(1)
+    atexit.register(release_instance_lock, lock_fd)
 
     def cleanup_and_exit(signum=None, frame=None):
-        """Cleanup function called on exit."""
-        try:
-            lock.release()
-        except:
-            pass
+        """Cleanup function called on exit; atexit releases the lock."""
         sys.exit(0)
 
     # Register signal handlers for clean shutdown
@@ -517,7 +1131,7 @@ def main():
     claude = ClaudeRunner(REPO_DIR)
     screenshotter = ScreenshotTaker(REPO_DIR)
 
-    bot.send_message(
+    await bot.send_message(
         "[ONLINE] Claude Bridge is ONLINE!\n\n"
         "Commands:\n"
         "- Send any message → Claude responds\n"
@@ -530,113 +1144,47 @@ def main():
     )
 
     offset = None
+    chat_locks = {}
+    pending_tasks = set()
 
     while True:
         try:
-            updates = bot.get_updates(offset=offset, timeout=30)
+            updates = await bot.get_updates(offset=offset)
+
+            if updates is None:
+                # Poll failed (network outage, API error): back off so
+                # the loop doesn't spin at full speed until it recovers
+                await asyncio.sleep(5)
+                continue
 
             for update in updates.get("result", []):
+                # Advance the offset immediately so slow handlers never
+                # hold up acknowledgement of later updates.
                 offset = update["update_id"] + 1
 
-                message = update.get("message", {})
-                text = message.get("text", "").strip()
-                user_id = str(message.get("from", {}).get("id", ""))
-
-                if not text:
-                    continue
-
-                # Check authorization
-                if str(user_id) != str(ALLOWED_USER_ID):
-                    bot.send_message("⛔ Unauthorized user")
-                    continue
-
-                print(f"[{datetime.now()}] Received: {text[:50]}...")
-
-                # Handle commands
-                if text.startswith("/status"):
-                    status = "[ONLINE]" if not claude.is_running else "[PROCESSING]"
-                    bot.send_message(f"Status: {status}\nRepo: {REPO_DIR}")
-
-                elif text.startswith("/pr "):
-                    description = text[4:].strip()
-                    if not description:
-                        bot.send_message("Usage: /pr <description of changes>")
-                    else:
-                        bot.send_message("[WAIT] Creating PR...")
-                        result = claude.create_pr(description)
-                        bot.send_message(result)
-
-                elif text.startswith("/shot"):
-                    args = text[5:].strip()  # Get everything after "/shot"
-
-                    if not args:
-                        # /shot → screenshot default page
-                        bot.send_message("[WAIT] Taking screenshot of default page...")
-                        screenshot_path = screenshotter.take_project_screenshot('default')
-                        caption = "Screenshot: Default page"
-
-                    elif args.lower() in ['project', 'build', 'app', 'page']:
-                        # /shot project|build|app|page
-                        bot.send_message(f"[WAIT] Taking screenshot of {args} page...")
-                        screenshot_path = screenshotter.take_project_screenshot(args.lower())
-                        caption = f"Screenshot: {args.capitalize()} page"
-
-                    else:
-                        # /shot <url> (existing behavior)
-                        url = args if args.startswith("http") else "https://" + args
-                        bot.send_message(f"[WAIT] Taking screenshot of {url}...")
-                        screenshot_path = screenshotter.take_browser_screenshot(url)
-                        caption = f"Screenshot: {url}"
-
-                    if screenshot_path:
-                        bot.send_photo(screenshot_path, caption=caption)
-                    else:
-                        bot.send_message("[ERROR] Screenshot failed. Check logs.")
-
-                elif text.startswith("/"):
-                    bot.send_message("Unknown command. Available:\n/status\n/pr <description>\n/shot <url>")
-
-                else:
-                    # Check for natural language screenshot commands
-                    is_screenshot, keyword, url = parse_screenshot_intent(text)
-
-                    if is_screenshot:
-                        if url:
-                            # External URL from natural language
-                            url = url if url.startswith("http") else "https://" + url
-                            bot.send_message(f"[WAIT] Taking screenshot of {url}...")
-                            screenshot_path = screenshotter.take_browser_screenshot(url)
-                            caption = f"Screenshot: {url}"
-                        else:
-                            # Local HTML file
-                            target = keyword or 'default'
-                            bot.send_message(f"[WAIT] Taking screenshot of {target} page...")
-                            screenshot_path = screenshotter.take_project_screenshot(target)
-                            caption = f"Screenshot: {target.capitalize()} page"
-
-                        if screenshot_path:
-                            bot.send_photo(screenshot_path, caption=caption)
-                        else:
-                            bot.send_message("[ERROR] Screenshot failed. Check logs.")
-
-                        continue  # Skip Claude processing
-
-                    # If not a screenshot command, continue to Claude handler
-
-                    bot.send_message("[WAIT] Claude is thinking...")
-                    response = claude.run(text)
-                    bot.send_message(response)
-                    print(f"[{datetime.now()}] Responded ({len(response)} chars)")
-
-            time.sleep(1)
+                task = asyncio.create_task(
+                    handle_update(update, bot, claude, screenshotter, chat_locks)
+                )
+                pending_tasks.add(task)
+                task.add_done_callback(pending_tasks.discard)
 
         except KeyboardInterrupt:
-            bot.send_message("[OFFLINE] Claude Bridge is going OFFLINE")
+            await bot.send_message("[OFFLINE] Claude Bridge is going OFFLINE")
             print("\nShutting down...")
+            await claude.pool.close_all()
+            screenshotter.close()
+            await bot.close()
             cleanup_and_exit()
         except Exception as e:
             print(f"[ERROR] Error in main loop: {e}")
-            time.sleep(5)
+            await asyncio.sleep(5)
+
+
+def main():
+    try:
+        asyncio.run(async_main())
+    except KeyboardInterrupt:
+        print("\nShutting down...")
 
 
 if __name__ == "__main__":
@@ -45,7 +45,7 @@ def main():
 
     # Check required Python packages
     print("\n3. Checking Python packages...")
-    packages = ["requests"]
+    packages = ["aiohttp", "python-dotenv"]
     for package in packages:
         run_command(f"pip show {package}", f"Package: {package}")
 